@@ -1,32 +1,46 @@
 # main.py - FastAPI Authentication API
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, StringConstraints
+from contextlib import asynccontextmanager
+from typing import Annotated, Optional
 import asyncpg
+import orjson
+import asyncio
 import os
 import logging
-from datetime import datetime
+import time
+import zlib
+from datetime import datetime, timezone
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Machine Authentication API", version="1.0.0")
+def _configure_logging():
+    """Attach a handler to this module's logger only, leaving uvicorn's loggers alone"""
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    logger.addHandler(handler)
+    logger.propagate = False
+    
+    level = os.getenv("LOG_LEVEL", "INFO").upper()
+    if level not in logging.getLevelNamesMapping():
+        logger.setLevel(logging.INFO)
+        logger.warning("Invalid LOG_LEVEL %r; falling back to INFO", level)
+        return
+    logger.setLevel(level)
 
-# Enable CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Configure for your specific domains in production
-    allow_credentials=True,
-    allow_methods=["GET", "POST", "PUT", "DELETE"],
-    allow_headers=["*"],
-)
+def _log_auth(machine_id: str, outcome: str):
+    """The single log record emitted per /auth request"""
+    logger.info("auth machine_id=%s outcome=%s", machine_id, outcome)
 
 # Pydantic models
 class AuthRequest(BaseModel):
-    machineId: str
-    key: Optional[str] = None
+    machineId: Annotated[str, StringConstraints(min_length=1, max_length=256, strip_whitespace=True)]
+    # An empty key is still accepted and treated as auto-login
+    key: Optional[Annotated[str, StringConstraints(max_length=256, strip_whitespace=True)]] = None
 
 class AuthResponse(BaseModel):
     success: bool
@@ -39,12 +53,107 @@ class ErrorResponse(BaseModel):
     received: dict
     error: Optional[str] = None
 
-# Database connection pool
-db_pool = None
+# Hot-path SQL; asyncpg's per-connection statement cache prepares each one on first use.
+# expires_at is cast to timestamptz explicitly so comparisons behave the same whether
+# the column is TIMESTAMPTZ or a plain timestamp (read in the session TimeZone).
+# It is returned as float epoch seconds (expires_epoch) so asyncpg never has to
+# build a datetime on the hot path.
+SQL_STATEMENTS = {
+    "auto_login": """
+        SELECT expires_at::timestamptz >= now() AS valid,
+               extract(epoch FROM expires_at::timestamptz)::float8 AS expires_epoch
+        FROM user_keys WHERE machine_id = $1
+    """,
+    # Binds an unclaimed (NULL or empty machine_id), unexpired key to $1 and reports
+    # whether this call claimed it.
+    # The locked subquery exposes the pre-update machine_id and closes the race between
+    # two concurrent first-time activations.
+    "activate": """
+        UPDATE user_keys AS k
+        SET machine_id = CASE WHEN k.expires_at::timestamptz < now() THEN k.machine_id
+                              ELSE COALESCE(NULLIF(k.machine_id, ''), $1) END
+        FROM (SELECT id, machine_id FROM user_keys WHERE key_value = $2 FOR UPDATE) AS prev
+        WHERE k.id = prev.id
+        RETURNING k.id, extract(epoch FROM k.expires_at::timestamptz)::float8 AS expires_epoch,
+                  k.expires_at::timestamptz < now() AS expired, k.machine_id,
+                  NULLIF(prev.machine_id, '') IS NULL AS activated
+    """,
+    "machine_status": "SELECT extract(epoch FROM expires_at::timestamptz)::float8 AS expires_epoch FROM user_keys WHERE machine_id = $1",
+}
+
+# Auto-login cache: machine_id -> (expires_at epoch seconds, cached_at monotonic timestamp).
+# Entries are kept in write order, so stale ones always sit at the front of the dict.
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", 60))
+AUTH_CACHE_MAX_SIZE = int(os.getenv("AUTH_CACHE_MAX_SIZE", 10000))
+_auth_cache: dict[str, tuple[float, float]] = {}
+_auth_cache_lock = asyncio.Lock()
+
+# Client-side cache lifetime for /machines/{machine_id}/status responses
+STATUS_MAX_AGE = int(os.getenv("STATUS_MAX_AGE", 30))
+
+def _get_cached_expiry(machine_id: str) -> Optional[float]:
+    """Return the cached expires_at epoch for a machine, or None if missing/stale"""
+    entry = _auth_cache.get(machine_id)
+    if entry is None:
+        return None
+    expires_at, cached_at = entry
+    if cached_at + AUTH_CACHE_TTL <= time.monotonic():
+        return None
+    return expires_at
+
+async def _cache_expiry(machine_id: str, expires_at: float):
+    now = time.monotonic()
+    async with _auth_cache_lock:
+        _auth_cache.pop(machine_id, None)
+        _auth_cache[machine_id] = (expires_at, now)
+        # Prune stale entries, and the oldest ones beyond the size bound, from the front
+        while _auth_cache:
+            oldest = next(iter(_auth_cache))
+            if len(_auth_cache) <= AUTH_CACHE_MAX_SIZE and _auth_cache[oldest][1] + AUTH_CACHE_TTL > now:
+                break
+            del _auth_cache[oldest]
+
+async def _invalidate_expiry(machine_id: str):
+    async with _auth_cache_lock:
+        _auth_cache.pop(machine_id, None)
+
+# Requests are routed to one of SHARD_COUNT pools by a hash of machineId. All pools
+# connect to the same DATABASE_URL: unclaimed keys have no owning machine yet, so
+# user_keys cannot be partitioned by machineId across databases. Separate pools still
+# spread acquire() contention.
+# Each uvicorn worker opens SHARD_COUNT pools of DB_POOL_MIN..DB_POOL_MAX connections, so
+# the database can see up to workers x SHARD_COUNT x DB_POOL_MAX connections. With
+# --workers $(nproc) and the default DB_POOL_MAX of 20, an 8-core host already exceeds
+# Postgres's default max_connections=100; size these settings together.
+SHARD_COUNT = max(1, int(os.getenv("SHARD_COUNT", 1)))
 
-@app.on_event("startup")
-async def startup():
-    global db_pool
+async def _create_pool(database_url: str) -> asyncpg.Pool:
+    return await asyncpg.create_pool(
+        database_url,
+        ssl='require' if 'postgres://' in database_url else None,
+        min_size=int(os.getenv("DB_POOL_MIN", 5)),
+        max_size=int(os.getenv("DB_POOL_MAX", 20)),
+        max_inactive_connection_lifetime=float(os.getenv("DB_POOL_IDLE_TIMEOUT", 300)),
+        command_timeout=5,
+        statement_cache_size=1024
+    )
+
+async def _create_pools(database_url: str) -> list[asyncpg.Pool]:
+    """Create SHARD_COUNT pools, closing the ones that opened if any of them fails"""
+    results = await asyncio.gather(
+        *(_create_pool(database_url) for _ in range(SHARD_COUNT)),
+        return_exceptions=True
+    )
+    pools = [result for result in results if isinstance(result, asyncpg.Pool)]
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        await asyncio.gather(*(pool.close() for pool in pools), return_exceptions=True)
+        raise errors[0]
+    return pools
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    _configure_logging()
     database_url = os.getenv("DATABASE_URL")
     
     if not database_url:
@@ -52,77 +161,117 @@ async def startup():
         raise RuntimeError("DATABASE_URL environment variable is not set.")
     
     try:
-        db_pool = await asyncpg.create_pool(
-            database_url,
-            ssl='require' if 'postgres://' in database_url else None,
-            min_size=1,
-            max_size=10
-        )
-        logger.info("Database connection pool created successfully")
+        db_pools = await _create_pools(database_url)
+        logger.info("Database connection pools created successfully (%d shards)", len(db_pools))
     except Exception as e:
-        logger.error(f"Failed to create database pool: {e}")
+        logger.error("Failed to create database pool: %s", e)
         raise
+    
+    app.state.db_pools = db_pools
+    try:
+        yield
+    finally:
+        await asyncio.gather(*(pool.close() for pool in db_pools))
+        logger.info("Database connection pools closed")
+
+app = FastAPI(
+    title="Machine Authentication API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
+
+# Enable CORS for a comma-separated ALLOWED_ORIGINS list. Credentials are only
+# allowed with explicit origins; a wildcard origin with credentials is invalid CORS.
+ALLOWED_ORIGINS = tuple(
+    origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", "").split(",") if origin.strip()
+)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=ALLOWED_ORIGINS or ("*",),
+    allow_credentials=bool(ALLOWED_ORIGINS),
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["Content-Type", "Authorization"],
+    max_age=86400,
+)
+
+def get_pools(request: Request) -> list[asyncpg.Pool]:
+    """Dependency returning the shard pools; lifespan fails fast if they cannot be created"""
+    return request.app.state.db_pools
+
+def shard_pool(pools: list[asyncpg.Pool], machine_id: str) -> asyncpg.Pool:
+    """Pick the pool owning a machine_id"""
+    return pools[zlib.crc32(machine_id.encode()) % len(pools)]
 
-@app.on_event("shutdown")
-async def shutdown():
-    global db_pool
-    if db_pool:
-        await db_pool.close()
-        logger.info("Database connection pool closed")
+# Static payloads, encoded once at import
+_ROOT_BODY = orjson.dumps({"message": "Machine Authentication API", "version": "1.0.0"})
+
+MSG_WELCOME_BACK = "Welcome back! Login successful."
+MSG_ACTIVATED = "Key successfully activated. Login successful."
+MSG_LOGIN_OK = "Login successful."
+
+def _auth_success(message: str, request_body: dict) -> ORJSONResponse:
+    """Successful AuthResponse, serialized directly without building the model"""
+    return ORJSONResponse({"success": True, "message": message, "received": request_body})
 
 @app.get("/")
 async def root():
-    return {"message": "Machine Authentication API", "version": "1.0.0"}
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
-@app.post("/auth", response_model=AuthResponse)
-async def authenticate(auth_request: AuthRequest, request: Request):
-    """
-    Authenticate machine with optional key activation.
-    
-    Flow 1 (Auto-login): Only machineId provided - check if machine is already registered
-    Flow 2 (Activation): machineId + key provided - activate new key or validate existing
-    """
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak If-None-Match comparison: any listed tag (W/ prefix ignored) or '*' matches"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+def _status_payload(machine_id: str, expires_epoch: float, now: float) -> dict:
+    is_expired = expires_epoch < now
+    return {
+        "machine_id": machine_id,
+        "expires_at": datetime.fromtimestamp(expires_epoch, timezone.utc),
+        "is_expired": is_expired,
+        "status": "expired" if is_expired else "active"
+    }
+
+async def _authenticate(auth_request: AuthRequest, pools: list[asyncpg.Pool], request_body: dict) -> tuple[str, float]:
+    """Shared /auth logic: returns the success message and license expiry (epoch seconds), or raises HTTPException"""
     
-    # Log the received request
-    request_body = auth_request.dict()
-    logger.info(f"Received request body: {request_body}")
+    now = time.time()
     
-    # Validate machineId is provided
-    if not auth_request.machineId:
-        logger.info("Missing machineId in request.")
-        raise HTTPException(
-            status_code=400,
-            detail={
-                "success": False,
-                "message": "Machine ID is required. Please provide a valid machineId.",
-                "received": request_body
-            }
-        )
-    
-    # Check database connection
-    if not db_pool:
-        logger.error("Database connection not available.")
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "success": False,
-                "message": "Server configuration error.",
-                "received": request_body
-            }
-        )
+    # FLOW 1 fast path: serve repeat auto-logins from the in-process cache
+    if not auth_request.key:
+        expiration_date = _get_cached_expiry(auth_request.machineId)
+        if expiration_date is not None:
+            if expiration_date < now:
+                _log_auth(auth_request.machineId, "expired_cached")
+                raise HTTPException(
+                    status_code=403,
+                    detail={
+                        "success": False,
+                        "message": "Your license has expired.",
+                        "received": request_body
+                    }
+                )
+            
+            _log_auth(auth_request.machineId, "ok_cached")
+            return MSG_WELCOME_BACK, expiration_date
     
+    pool = shard_pool(pools, auth_request.machineId)
     try:
-        async with db_pool.acquire() as connection:
+        async with pool.acquire() as connection:
             
             # FLOW 1: AUTO-LOGIN (No key provided)
             if not auth_request.key:
-                logger.info(f"Auto-login attempt for Machine ID: {auth_request.machineId}")
+                license_record = await connection.fetchrow(SQL_STATEMENTS["auto_login"], auth_request.machineId)
                 
-                query = "SELECT expires_at FROM user_keys WHERE machine_id = $1"
-                rows = await connection.fetch(query, auth_request.machineId)
-                
-                if not rows:
-                    logger.info(f"Machine ID {auth_request.machineId} not found for auto-login.")
+                if license_record is None:
+                    _log_auth(auth_request.machineId, "not_registered")
+                    await _invalidate_expiry(auth_request.machineId)
                     raise HTTPException(
                         status_code=404,
                         detail={
@@ -132,12 +281,11 @@ async def authenticate(auth_request: AuthRequest, request: Request):
                         }
                     )
                 
-                license_record = rows[0]
-                expiration_date = license_record['expires_at']
-                current_time = datetime.now()
+                expiration_date = license_record['expires_epoch']
+                await _cache_expiry(auth_request.machineId, expiration_date)
                 
-                if expiration_date < current_time:
-                    logger.info(f"License for Machine ID {auth_request.machineId} has expired.")
+                if not license_record['valid']:
+                    _log_auth(auth_request.machineId, "expired")
                     raise HTTPException(
                         status_code=403,
                         detail={
@@ -147,21 +295,15 @@ async def authenticate(auth_request: AuthRequest, request: Request):
                         }
                     )
                 
-                logger.info(f"Successful auto-login for Machine ID: {auth_request.machineId}")
-                return AuthResponse(
-                    success=True,
-                    message="Welcome back! Login successful.",
-                    received=request_body
-                )
+                _log_auth(auth_request.machineId, "ok")
+                return MSG_WELCOME_BACK, expiration_date
             
             # FLOW 2: ACTIVATION / VALIDATION (Key is provided)
             if auth_request.key:
-                logger.info(f"Activation attempt with key on Machine ID: {auth_request.machineId}")
-                
-                query = "SELECT id, expires_at, machine_id FROM user_keys WHERE key_value = $1"
-                rows = await connection.fetch(query, auth_request.key)
+                license_record = await connection.fetchrow(SQL_STATEMENTS["activate"], auth_request.machineId, auth_request.key)
                 
-                if not rows:
+                if license_record is None:
+                    _log_auth(auth_request.machineId, "invalid_key")
                     raise HTTPException(
                         status_code=404,
                         detail={
@@ -171,11 +313,10 @@ async def authenticate(auth_request: AuthRequest, request: Request):
                         }
                     )
                 
-                license_record = rows[0]
-                expiration_date = license_record['expires_at']
-                current_time = datetime.now()
+                expiration_date = license_record['expires_epoch']
                 
-                if expiration_date < current_time:
+                if license_record['expired']:
+                    _log_auth(auth_request.machineId, "key_expired")
                     raise HTTPException(
                         status_code=403,
                         detail={
@@ -185,16 +326,9 @@ async def authenticate(auth_request: AuthRequest, request: Request):
                         }
                     )
                 
-                # Key already associated with this machine
-                if license_record['machine_id'] and license_record['machine_id'] == auth_request.machineId:
-                    return AuthResponse(
-                        success=True,
-                        message="Login successful.",
-                        received=request_body
-                    )
-                
                 # Key already associated with different machine
-                if license_record['machine_id'] and license_record['machine_id'] != auth_request.machineId:
+                if license_record['machine_id'] != auth_request.machineId:
+                    _log_auth(auth_request.machineId, "key_in_use")
                     raise HTTPException(
                         status_code=403,
                         detail={
@@ -204,23 +338,22 @@ async def authenticate(auth_request: AuthRequest, request: Request):
                         }
                     )
                 
-                # Associate the key with the machineId (first time activation)
-                if not license_record['machine_id']:
-                    update_query = "UPDATE user_keys SET machine_id = $1 WHERE key_value = $2"
-                    await connection.execute(update_query, auth_request.machineId, auth_request.key)
-                    logger.info(f"Key {auth_request.key} has been activated for Machine ID: {auth_request.machineId}")
-                    
-                    return AuthResponse(
-                        success=True,
-                        message="Key successfully activated. Login successful.",
-                        received=request_body
-                    )
+                await _cache_expiry(auth_request.machineId, expiration_date)
+                
+                # Key was associated with the machineId by this request (first time activation)
+                if license_record['activated']:
+                    _log_auth(auth_request.machineId, "activated")
+                    return MSG_ACTIVATED, expiration_date
+                
+                # Key already associated with this machine
+                _log_auth(auth_request.machineId, "ok")
+                return MSG_LOGIN_OK, expiration_date
     
     except HTTPException:
         # Re-raise HTTP exceptions
         raise
     except Exception as db_error:
-        logger.error(f"Database Error: {str(db_error)}")
+        logger.error("auth machine_id=%s outcome=error error=%s", auth_request.machineId, db_error)
         raise HTTPException(
             status_code=500,
             detail={
@@ -231,54 +364,80 @@ async def authenticate(auth_request: AuthRequest, request: Request):
             }
         )
 
+@app.post("/auth", response_model=AuthResponse)
+async def authenticate(auth_request: AuthRequest, request: Request, pools: list[asyncpg.Pool] = Depends(get_pools)):
+    """
+    Authenticate machine with optional key activation.
+    
+    Flow 1 (Auto-login): Only machineId provided - check if machine is already registered
+    Flow 2 (Activation): machineId + key provided - activate new key or validate existing
+    """
+    request_body = auth_request.model_dump()
+    message, _ = await _authenticate(auth_request, pools, request_body)
+    return _auth_success(message, request_body)
+
+@app.post("/auth/status")
+async def authenticate_with_status(auth_request: AuthRequest, pools: list[asyncpg.Pool] = Depends(get_pools)):
+    """Authenticate and return the machine status from the same lookup"""
+    request_body = auth_request.model_dump()
+    message, expires_epoch = await _authenticate(auth_request, pools, request_body)
+    return ORJSONResponse({
+        "success": True,
+        "message": message,
+        "received": request_body,
+        "machine_status": _status_payload(auth_request.machineId, expires_epoch, time.time())
+    })
+
 # Additional endpoints for management
 @app.get("/health")
-async def health_check():
+async def health_check(pools: list[asyncpg.Pool] = Depends(get_pools)):
     """Health check endpoint"""
     try:
-        if db_pool:
-            async with db_pool.acquire() as connection:
+        for pool in pools:
+            async with pool.acquire() as connection:
                 await connection.fetchval("SELECT 1")
-            return {"status": "healthy", "database": "connected"}
+        return {"status": "healthy", "database": "connected"}
     except Exception as e:
-        logger.error(f"Health check failed: {e}")
+        logger.error("Health check failed: %s", e)
         raise HTTPException(
             status_code=503,
             detail={"status": "unhealthy", "database": "disconnected", "error": str(e)}
         )
 
 @app.get("/machines/{machine_id}/status")
-async def get_machine_status(machine_id: str):
+async def get_machine_status(machine_id: str, request: Request, pools: list[asyncpg.Pool] = Depends(get_pools)):
     """Get the status of a specific machine"""
-    if not db_pool:
-        raise HTTPException(status_code=500, detail="Database connection not available")
+    now = time.time()
     
-    try:
-        async with db_pool.acquire() as connection:
-            query = "SELECT machine_id, expires_at, key_value FROM user_keys WHERE machine_id = $1"
-            rows = await connection.fetch(query, machine_id)
-            
-            if not rows:
-                raise HTTPException(
-                    status_code=404,
-                    detail={"message": "Machine not found"}
-                )
-            
-            license_record = rows[0]
-            current_time = datetime.now()
-            is_expired = license_record['expires_at'] < current_time
-            
-            return {
-                "machine_id": license_record['machine_id'],
-                "expires_at": license_record['expires_at'].isoformat(),
-                "is_expired": is_expired,
-                "status": "expired" if is_expired else "active"
-            }
+    # Shares the auto-login cache; only fall back to the database on a miss
+    expires_epoch = _get_cached_expiry(machine_id)
+    if expires_epoch is None:
+        try:
+            async with shard_pool(pools, machine_id).acquire() as connection:
+                license_record = await connection.fetchrow(SQL_STATEMENTS["machine_status"], machine_id)
+        except Exception as e:
+            logger.error("Error getting machine status: %s", e)
+            raise HTTPException(status_code=500, detail={"error": str(e)})
+        
+        if license_record is None:
+            await _invalidate_expiry(machine_id)
+            raise HTTPException(
+                status_code=404,
+                detail={"message": "Machine not found"}
+            )
+        
+        expires_epoch = license_record['expires_epoch']
+        await _cache_expiry(machine_id, expires_epoch)
     
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error getting machine status: {e}")
-        raise HTTPException(status_code=500, detail={"error": str(e)})
+    payload = _status_payload(machine_id, expires_epoch, now)
+    headers = {
+        "ETag": f'"{int(expires_epoch * 1_000_000):x}-{payload["status"]}"',
+        "Cache-Control": f"max-age={STATUS_MAX_AGE}",
+    }
+    if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    
+    return ORJSONResponse(payload, headers=headers)
 
-# Run with: uvicorn main:app --reload --host 0.0.0.0 --port 8000
+# Create indexes (once per deploy): python migrate.py
+# Run with: uvicorn api:app --loop uvloop --http httptools --no-access-log --workers $(nproc) --host 0.0.0.0 --port 8000
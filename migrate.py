@@ -0,0 +1,58 @@
+# migrate.py - one-off schema changes for the Machine Authentication API
+# Run once per deploy, before starting the workers: python migrate.py
+import asyncio
+import logging
+import os
+
+import asyncpg
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Covering indexes so the hot-path lookups in api.py are index-only scans
+INDEXES = {
+    "idx_user_keys_key_value": (
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_user_keys_key_value "
+        "ON user_keys (key_value) INCLUDE (expires_at, machine_id)"
+    ),
+    "idx_user_keys_machine_id": (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_keys_machine_id "
+        "ON user_keys (machine_id) INCLUDE (expires_at)"
+    ),
+}
+
+async def ensure_index(connection: asyncpg.Connection, name: str, statement: str):
+    """Create an index, first dropping it if an earlier concurrent build left it INVALID"""
+    is_valid = await connection.fetchval(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = $1 AND pg_table_is_visible(c.oid)",
+        name
+    )
+    if is_valid is False:
+        logger.warning("Index %s is invalid; rebuilding", name)
+        await connection.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+    await connection.execute(statement)
+    logger.info("Index %s is in place", name)
+
+async def main():
+    database_url = os.getenv("DATABASE_URL")
+
+    if not database_url:
+        raise RuntimeError("DATABASE_URL environment variable is not set.")
+
+    # Dedicated connection without a command timeout: concurrent builds can take a while
+    connection = await asyncpg.connect(
+        database_url,
+        ssl='require' if 'postgres://' in database_url else None,
+        command_timeout=None
+    )
+    try:
+        # CONCURRENTLY cannot run inside a transaction block, so build one index at a time
+        for name, statement in INDEXES.items():
+            await ensure_index(connection, name, statement)
+    finally:
+        await connection.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())